@@ -1,10 +1,18 @@
 ﻿import requests
+from requests.adapters import HTTPAdapter
 import time
 import sqlite3
 import logging
 import random
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from config import BOT_TOKEN, ORGANIZER_IDS
 
+# Organizer checks run on every admin command
+ORGANIZER_IDS = frozenset(ORGANIZER_IDS)
+
 # Setup logging
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -12,18 +20,153 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Telegram rejects messages longer than 4096 characters
+MAX_MESSAGE_LENGTH = 4000
+
+# Unfinished registrations are dropped after an hour of inactivity
+REG_STATE_TTL = 3600
+REG_SWEEP_INTERVAL = 300
+
+# How many users to remember as already told to use /start
+PROMPTED_CACHE_SIZE = 10000
+
+# Prepared SQL. Identical strings let sqlite3's per-connection statement cache reuse compiled statements
+SQL_GET_SETTINGS = "SELECT registration_open, event_started FROM event_settings WHERE id = 1"
+SQL_SET_REGISTRATION_OPEN = "UPDATE event_settings SET registration_open = ? WHERE id = 1"
+SQL_SET_EVENT_STARTED = "UPDATE event_settings SET event_started = 1 WHERE id = 1"
+SQL_GET_USER = "SELECT id, fio, santa_id FROM users WHERE telegram_id = ?"
+SQL_GET_USER_BY_ID = "SELECT id, fio, group_name FROM users WHERE id = ?"
+SQL_GET_ALL_USERS = "SELECT id, fio, group_name, gift_delivered, gift_received FROM users"
+SQL_GET_USER_IDS = "SELECT id FROM users"
+SQL_GET_SANTA_ID = "SELECT santa_id FROM users WHERE id = ?"
+SQL_GET_PREFERENCES = "SELECT preferences FROM users WHERE id = ?"
+SQL_GET_TELEGRAM_ID = "SELECT telegram_id FROM users WHERE id = ?"
+SQL_GET_NEW_ASSIGNMENTS = """
+    SELECT u.telegram_id, u.id, r.id, r.preferences
+    FROM users u
+    JOIN users r ON r.id = u.santa_id
+"""
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+SQL_COUNT_DELIVERED = "SELECT COUNT(*) FROM users WHERE gift_delivered = 1"
+SQL_COUNT_RECEIVED = "SELECT COUNT(*) FROM users WHERE gift_received = 1"
+SQL_INSERT_USER = "INSERT INTO users (telegram_id, fio, group_name, preferences) VALUES (?, ?, ?, ?)"
+SQL_INSERT_USER_RETURNING = SQL_INSERT_USER + " RETURNING id"
+SQL_SET_SANTA = "UPDATE users SET santa_id = ? WHERE id = ?"
+SQL_MARK_DELIVERED = "UPDATE users SET gift_delivered = 1 WHERE id = ?"
+SQL_MARK_RECEIVED = "UPDATE users SET gift_received = 1 WHERE id = ?"
+SQL_DELETE_USER = "DELETE FROM users WHERE id = ?"
+
+# INSERT ... RETURNING needs SQLite 3.35+
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class RateLimiter:
+    """Thread-safe token bucket"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RegState:
+    """Registration progress of a single user"""
+    __slots__ = ("step", "fio", "group", "ts")
+    
+    def __init__(self, step="fio", fio="", group=""):
+        self.step = step
+        self.fio = fio
+        self.group = group
+        self.ts = time.monotonic()
+
 
 class SimpleSantaBot:
-    def __init__(self, token):
+    def __init__(self, token, max_attempts=3, num_workers=4):
         self.token = token
+        self.max_attempts = max_attempts
         self.base_url = f"https://api.telegram.org/bot{token}/"
         self.last_update_id = 0
         self.user_data = {}
-        
-    def init_database(self):
-        """Initialize database"""
+        # Serializes registration updates with the reaper
+        self._user_data_lock = threading.Lock()
+        self._prompted = OrderedDict()
+        self._prompted_lock = threading.Lock()
+        self.session = self._create_session()
+        # Telegram allows ~30 messages per second across all chats
+        self.send_limiter = RateLimiter(25)
+        # Shared pool for broadcasts, so they don't hold up the update workers
+        self.send_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sender")
+        self._local = threading.local()
+        self.num_workers = num_workers
+        self.work_queues = []
+        self._admin_dispatch = {
+            "/stats": self._cmd_stats,
+            "/users": self._cmd_users,
+            "/close": self._cmd_close,
+            "/open": self._cmd_open,
+            "/start_event": self._cmd_start_event,
+            "/del": self._cmd_del,
+            "/gift": self._cmd_gift,
+            "/received": self._cmd_received,
+            "/help_admin": self._cmd_help_admin,
+        }
+        self._settings = None
+        # Guards the settings cache; bumped on every write so stale loads are discarded
+        self._settings_lock = threading.Lock()
+        self._settings_generation = 0
+        
+    def _create_session(self):
+        """Create HTTP session with a keep-alive connection pool"""
+        session = requests.Session()
+        # Retries are handled in make_request
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0)
+        session.mount("https://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+    
+    @property
+    def conn(self):
+        """Database connection owned by the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+    
+    def _connect(self):
+        """Open a database connection for the current thread"""
         conn = sqlite3.connect('santa.db')
         cursor = conn.cursor()
+
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA busy_timeout = 5000")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        cursor.execute("PRAGMA cache_size = -64000")
+        cursor.execute("PRAGMA foreign_keys = ON")
+
+        journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode != "wal":
+            logger.warning(f"Database journal mode: {journal_mode} (WAL not available)")
+
+        return conn
+    
+    def init_database(self):
+        """Initialize database"""
+        cursor = self.conn.cursor()
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -38,6 +181,9 @@ class SimpleSantaBot:
             )
         ''')
         
+        # No query filters on santa_id any more; the index only slowed down the draw
+        cursor.execute("DROP INDEX IF EXISTS idx_users_santa_id")
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS event_settings (
                 id INTEGER PRIMARY KEY CHECK (id = 1),
@@ -51,41 +197,58 @@ class SimpleSantaBot:
             VALUES (1, 1, 0)
         ''')
         
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized")
+        self.conn.commit()
+        
+        journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+        logger.info(f"Database journal mode: {journal_mode}")
+        logger.info(f"Database initialized (SQLite {sqlite3.sqlite_version}, RETURNING {'on' if SQLITE_HAS_RETURNING else 'off'})")
     
-    def is_registration_open(self):
-        """Check if registration is open"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT registration_open FROM event_settings WHERE id = 1")
+    def _get_settings(self):
+        """Get cached (registration_open, event_started) flags"""
+        with self._settings_lock:
+            settings = self._settings
+            generation = self._settings_generation
+        if settings is not None:
+            return settings
+        
+        cursor = self.conn.cursor()
+        cursor.execute(SQL_GET_SETTINGS)
         result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else False
+        settings = (bool(result[0]), bool(result[1])) if result else (False, False)
+        
+        with self._settings_lock:
+            # Only cache if no admin command changed the settings meanwhile
+            if self._settings_generation == generation:
+                self._settings = settings
+        return settings
     
-    def is_event_started(self):
-        """Check if event has started"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT event_started FROM event_settings WHERE id = 1")
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else False
+    def _invalidate_settings(self):
+        """Drop cached settings after they were changed"""
+        with self._settings_lock:
+            self._settings = None
+            self._settings_generation += 1
     
     def make_request(self, method, params=None, json_data=None):
         """Make request with retry logic"""
         url = self.base_url + method
         
-        for attempt in range(3):
+        for attempt in range(self.max_attempts):
+            retry_after = None
             try:
                 if json_data:
-                    response = requests.post(url, json=json_data, timeout=20)
+                    response = self.session.post(url, json=json_data, timeout=20)
                 else:
-                    response = requests.get(url, params=params, timeout=20)
+                    response = self.session.get(url, params=params, timeout=35)
                 
                 if response.status_code == 200:
                     return response.json()
+                elif response.status_code == 429:
+                    # Telegram tells us how long to wait before retrying
+                    try:
+                        retry_after = response.json().get("parameters", {}).get("retry_after")
+                    except ValueError:
+                        retry_after = None
+                    logger.warning(f"Rate limited on attempt {attempt + 1}, retry after {retry_after}s")
                 else:
                     logger.warning(f"HTTP {response.status_code} on attempt {attempt + 1}")
                     
@@ -96,8 +259,13 @@ class SimpleSantaBot:
             except Exception as e:
                 logger.error(f"Error on attempt {attempt + 1}: {e}")
             
-            if attempt < 2:  # Don't sleep after last attempt
-                time.sleep(2)
+            if attempt < self.max_attempts - 1:  # Don't sleep after last attempt
+                if retry_after is not None:
+                    delay = retry_after
+                else:
+                    # Exponential backoff with jitter
+                    delay = min(30, 1.0 * (2 ** attempt)) * (1 + random.random() * 0.5)
+                time.sleep(delay)
         
         return None
     
@@ -105,7 +273,7 @@ class SimpleSantaBot:
         """Get new messages"""
         params = {
             "offset": self.last_update_id + 1,
-            "timeout": 10,
+            "timeout": 30,
             "limit": 100
         }
         
@@ -121,6 +289,7 @@ class SimpleSantaBot:
             "text": text
         }
         
+        self.send_limiter.acquire()
         result = self.make_request("sendMessage", json_data=json_data)
         if result and result.get("ok"):
             logger.info(f"Message sent to {chat_id}")
@@ -129,161 +298,197 @@ class SimpleSantaBot:
             logger.error(f"Failed to send message to {chat_id}")
             return False
     
+    def send_long_message(self, chat_id, parts):
+        """Send text pieces, splitting into several messages to fit Telegram's limit"""
+        chunk = []
+        chunk_len = 0
+        for part in parts:
+            # Pieces longer than the limit are cut before being packed
+            for i in range(0, len(part), MAX_MESSAGE_LENGTH):
+                piece = part[i:i + MAX_MESSAGE_LENGTH]
+                if chunk and chunk_len + len(piece) > MAX_MESSAGE_LENGTH:
+                    self.send_message(chat_id, "".join(chunk))
+                    chunk = []
+                    chunk_len = 0
+                chunk.append(piece)
+                chunk_len += len(piece)
+        
+        if chunk:
+            self.send_message(chat_id, "".join(chunk))
+    
     def handle_start(self, chat_id, user_id, user_name):
         """Handle /start command"""
         # Check if user exists in database
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (user_id,))
+        cursor = self.conn.cursor()
+        cursor.execute(SQL_GET_USER, (user_id,))
         existing_user = cursor.fetchone()
-        conn.close()
+        
+        reg_open, ev_started = self._get_settings()
         
         if existing_user:
-            if self.is_event_started():
+            if ev_started:
                 # If event started, show assignment
                 self.show_assignment(chat_id, existing_user[0])
             else:
-                self.send_message(chat_id, f"Привет, {existing_user[2]}! Ты уже зарегистрирован.\nТвой ID: Тайный Дед Мороз {existing_user[0]}\n\nЖди начала мероприятия!")
+                self.send_message(chat_id, f"Привет, {existing_user[1]}! Ты уже зарегистрирован.\nТвой ID: Тайный Дед Мороз {existing_user[0]}\n\nЖди начала мероприятия!")
             return
         
-        if not self.is_registration_open():
+        if not reg_open:
             self.send_message(chat_id, "Регистрация на мероприятие закрыта! 🎅")
             return
         
         # Start registration
         self.send_message(chat_id, f"Привет, {user_name}! 🎄\nДобро пожаловать в Тайного Деда Мороза!\n\nВведи свое ФИО:")
-        self.user_data[user_id] = {"step": "fio"}
+        with self._user_data_lock:
+            self.user_data[user_id] = RegState()
+        with self._prompted_lock:
+            self._prompted.pop(user_id, None)
     
     def show_assignment(self, chat_id, user_db_id):
         """Show user who they should gift to"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
         
         # Get who this user should gift to
-        cursor.execute("SELECT santa_id FROM users WHERE id = ?", (user_db_id,))
+        cursor.execute(SQL_GET_SANTA_ID, (user_db_id,))
         result = cursor.fetchone()
         
-        if result and result[0]:
-            receiver_id = result[0]
+        receiver_id = result[0] if result else None
+        preferences = None
+        
+        if receiver_id:
             # Get receiver's preferences
-            cursor.execute("SELECT preferences FROM users WHERE id = ?", (receiver_id,))
+            cursor.execute(SQL_GET_PREFERENCES, (receiver_id,))
             preferences_result = cursor.fetchone()
             preferences = preferences_result[0] if preferences_result else "Не указано"
-            
-            message = f"""🎅 Ты даришь подарок Тайному Деду Морозу {receiver_id}
+        
+        self._send_assignment(chat_id, receiver_id, preferences)
+    
+    def _send_assignment(self, chat_id, receiver_id, preferences):
+        """Send assignment message to a giver"""
+        if not receiver_id:
+            self.send_message(chat_id, "Жеребьевка еще не проведена или произошла ошибка.")
+            return
+        
+        message = f"""🎅 Ты даришь подарок Тайному Деду Морозу {receiver_id}
 
 Его предпочтения:
 {preferences}
 
 📦 Принести подарок необходимо в аудиторию 257 до 18 декабря.
 ✏️ Не забудь подписать на подарке ID {receiver_id}"""
-            
-            self.send_message(chat_id, message)
-        else:
-            self.send_message(chat_id, "Жеребьевка еще не проведена или произошла ошибка.")
         
-        conn.close()
+        self.send_message(chat_id, message)
     
-    def handle_admin_commands(self, chat_id, text, user_id):
+    def handle_admin_commands(self, chat_id, text, user_id, handler):
         """Handle admin commands"""
         if user_id not in ORGANIZER_IDS:
             self.send_message(chat_id, "У вас нет прав администратора")
             return
         
-        if text == "/stats":
-            conn = sqlite3.connect('santa.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM users WHERE gift_delivered = 1")
-            delivered_gifts = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM users WHERE gift_received = 1")
-            received_gifts = cursor.fetchone()[0]
-            
-            conn.close()
-            
-            message = f"""📊 Статистика мероприятия:
+        handler(chat_id, text)
+    
+    def _cmd_stats(self, chat_id, text):
+        """Show event statistics"""
+        cursor = self.conn.cursor()
+        cursor.execute(SQL_COUNT_USERS)
+        total_users = cursor.fetchone()[0]
+        
+        cursor.execute(SQL_COUNT_DELIVERED)
+        delivered_gifts = cursor.fetchone()[0]
+        
+        cursor.execute(SQL_COUNT_RECEIVED)
+        received_gifts = cursor.fetchone()[0]
+        
+        reg_open, ev_started = self._get_settings()
+        
+        message = f"""📊 Статистика мероприятия:
 
 👥 Зарегистрировано участников: {total_users}
 🎁 Подарков доставлено: {delivered_gifts}
 🎁 Подарков получено: {received_gifts}
 
-Регистрация: {"✅ Открыта" if self.is_registration_open() else "❌ Закрыта"}
-Мероприятие: {"✅ Началось" if self.is_event_started() else "❌ Не началось"}"""
-            
-            self.send_message(chat_id, message)
-        
-        elif text == "/users":
-            users = self.get_all_users()
-            if not users:
-                self.send_message(chat_id, "Нет зарегистрированных пользователей")
-                return
-            
-            message = "📋 Список участников:\n\n"
-            for user in users:
-                delivered = "✅" if user[6] else "❌"
-                received = "✅" if user[7] else "❌"
-                message += f"🎅 {user[2]} (ID: {user[0]})\nГруппа: {user[3]}\nПодарок: {delivered} Получен: {received}\n\n"
-            
-            self.send_message(chat_id, message)
-        
-        elif text == "/close":
-            self.close_registration()
-            self.send_message(chat_id, "✅ Регистрация закрыта!")
-        
-        elif text == "/open":
-            self.open_registration()
-            self.send_message(chat_id, "✅ Регистрация открыта!")
-        
-        elif text == "/start_event":
-            count = self.start_santa()
-            if count > 1:
-                self.send_message(chat_id, f"✅ Жеребьевка завершена! Участников: {count}")
-                # Notify all users
-                self.notify_all_users()
-            else:
-                self.send_message(chat_id, "❌ Для жеребьевки нужно минимум 2 участника")
-        
-        elif text.startswith("/del "):
-            try:
-                user_id_to_delete = int(text.split()[1])
-                user_info = self.delete_user(user_id_to_delete)
-                if user_info:
-                    self.send_message(chat_id, f"✅ Пользователь удален:\nID: {user_info[0]}\nФИО: {user_info[2]}\nГруппа: {user_info[3]}")
-                    # Если мероприятие уже началось, нужно перепровести жеребьевку
-                    if self.is_event_started():
-                        self.send_message(chat_id, "⚠️ Мероприятие уже началось. Рекомендуется перепровести жеребьевку командой /start_event")
-                else:
-                    self.send_message(chat_id, "❌ Пользователь с таким ID не найден")
-            except (IndexError, ValueError):
-                self.send_message(chat_id, "Использование: /del <ID>\n\nНапример: /del 5")
+Регистрация: {"✅ Открыта" if reg_open else "❌ Закрыта"}
+Мероприятие: {"✅ Началось" if ev_started else "❌ Не началось"}"""
         
-        elif text.startswith("/gift "):
-            try:
-                user_id_to_mark = int(text.split()[1])
-                if self.mark_gift_delivered(user_id_to_mark):
-                    self.send_message(chat_id, f"✅ Подарок от Тайного Деда Мороза {user_id_to_mark} отмечен как доставленный")
-                    # Notify the receiver
-                    self.notify_gift_delivered(user_id_to_mark)
-                else:
-                    self.send_message(chat_id, "❌ Пользователь не найден")
-            except (IndexError, ValueError):
-                self.send_message(chat_id, "Использование: /gift <ID>\n\nНапример: /gift 3")
+        self.send_message(chat_id, message)
+    
+    def _cmd_users(self, chat_id, text):
+        """List registered users"""
+        users = self.get_all_users()
+        if not users:
+            self.send_message(chat_id, "Нет зарегистрированных пользователей")
+            return
         
-        elif text.startswith("/received "):
-            try:
-                user_id_to_mark = int(text.split()[1])
-                if self.mark_gift_received(user_id_to_mark):
-                    self.send_message(chat_id, f"✅ Подарок для Тайного Деда Мороза {user_id_to_mark} отмечен как полученный")
-                else:
-                    self.send_message(chat_id, "❌ Пользователь не найден")
-            except (IndexError, ValueError):
-                self.send_message(chat_id, "Использование: /received <ID>\n\nНапример: /received 7")
+        parts = ["📋 Список участников:\n\n"]
+        for user in users:
+            delivered = "✅" if user[3] else "❌"
+            received = "✅" if user[4] else "❌"
+            parts.append(f"🎅 {user[1]} (ID: {user[0]})\nГруппа: {user[2]}\nПодарок: {delivered} Получен: {received}\n\n")
         
-        elif text == "/help_admin":
-            message = """🎅 Команды организатора:
+        self.send_long_message(chat_id, parts)
+    
+    def _cmd_close(self, chat_id, text):
+        """Close registration"""
+        self.close_registration()
+        self.send_message(chat_id, "✅ Регистрация закрыта!")
+    
+    def _cmd_open(self, chat_id, text):
+        """Open registration"""
+        self.open_registration()
+        self.send_message(chat_id, "✅ Регистрация открыта!")
+    
+    def _cmd_start_event(self, chat_id, text):
+        """Run the assignment and notify everyone"""
+        assignments = self.start_santa()
+        if assignments:
+            self.send_message(chat_id, f"✅ Жеребьевка завершена! Участников: {len(assignments)}")
+            # Notify all users
+            self.broadcast_assignments(assignments)
+        else:
+            self.send_message(chat_id, "❌ Для жеребьевки нужно минимум 2 участника")
+    
+    def _cmd_del(self, chat_id, text):
+        """Delete a user"""
+        try:
+            user_id_to_delete = int(text.split()[1])
+            user_info = self.delete_user(user_id_to_delete)
+            if user_info:
+                self.send_message(chat_id, f"✅ Пользователь удален:\nID: {user_info[0]}\nФИО: {user_info[1]}\nГруппа: {user_info[2]}")
+                # Если мероприятие уже началось, нужно перепровести жеребьевку
+                if self._get_settings()[1]:
+                    self.send_message(chat_id, "⚠️ Мероприятие уже началось. Рекомендуется перепровести жеребьевку командой /start_event")
+            else:
+                self.send_message(chat_id, "❌ Пользователь с таким ID не найден")
+        except (IndexError, ValueError):
+            self.send_message(chat_id, "Использование: /del <ID>\n\nНапример: /del 5")
+    
+    def _cmd_gift(self, chat_id, text):
+        """Mark a gift as delivered"""
+        try:
+            user_id_to_mark = int(text.split()[1])
+            if self.mark_gift_delivered(user_id_to_mark):
+                self.send_message(chat_id, f"✅ Подарок от Тайного Деда Мороза {user_id_to_mark} отмечен как доставленный")
+                # Notify the receiver
+                self.notify_gift_delivered(user_id_to_mark)
+            else:
+                self.send_message(chat_id, "❌ Пользователь не найден")
+        except (IndexError, ValueError):
+            self.send_message(chat_id, "Использование: /gift <ID>\n\nНапример: /gift 3")
+    
+    def _cmd_received(self, chat_id, text):
+        """Mark a gift as received"""
+        try:
+            user_id_to_mark = int(text.split()[1])
+            if self.mark_gift_received(user_id_to_mark):
+                self.send_message(chat_id, f"✅ Подарок для Тайного Деда Мороза {user_id_to_mark} отмечен как полученный")
+            else:
+                self.send_message(chat_id, "❌ Пользователь не найден")
+        except (IndexError, ValueError):
+            self.send_message(chat_id, "Использование: /received <ID>\n\nНапример: /received 7")
+    
+    def _cmd_help_admin(self, chat_id, text):
+        """Show admin help"""
+        message = """🎅 Команды организатора:
 
 /stats - статистика
 /users - список участников  
@@ -298,131 +503,113 @@ class SimpleSantaBot:
 /del 5
 /gift 3
 /received 7"""
-            self.send_message(chat_id, message)
+        self.send_message(chat_id, message)
     
     def get_all_users(self):
         """Get all registered users"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users")
+        cursor = self.conn.cursor()
+        cursor.execute(SQL_GET_ALL_USERS)
         users = cursor.fetchall()
-        conn.close()
         return users
     
     def close_registration(self):
         """Close registration"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE event_settings SET registration_open = 0 WHERE id = 1")
-        conn.commit()
-        conn.close()
+        with self.conn:
+            self.conn.execute(SQL_SET_REGISTRATION_OPEN, (0,))
+        self._invalidate_settings()
     
     def open_registration(self):
         """Open registration"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE event_settings SET registration_open = 1 WHERE id = 1")
-        conn.commit()
-        conn.close()
+        with self.conn:
+            self.conn.execute(SQL_SET_REGISTRATION_OPEN, (1,))
+        self._invalidate_settings()
     
     def start_santa(self):
-        """Start secret santa assignment"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        
-        # Get all users
-        cursor.execute("SELECT id FROM users")
-        users = [row[0] for row in cursor.fetchall()]
-        
-        if len(users) < 2:
-            conn.close()
-            return len(users)
-        
-        # Shuffle and create pairs
-        random.shuffle(users)
-        
-        for i in range(len(users)):
-            giver = users[i]
-            receiver = users[(i + 1) % len(users)]
-            cursor.execute("UPDATE users SET santa_id = ? WHERE id = ?", (receiver, giver))
-        
-        cursor.execute("UPDATE event_settings SET event_started = 1 WHERE id = 1")
-        conn.commit()
-        conn.close()
+        """Start secret santa assignment, return the new assignments"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            # Take the write lock before reading, so nobody registers or gets
+            # deleted between reading the participants and assigning them
+            cursor.execute("BEGIN IMMEDIATE")
+            
+            # Get all users
+            cursor.execute(SQL_GET_USER_IDS)
+            users = [row[0] for row in cursor.fetchall()]
+            
+            if len(users) < 2:
+                return []
+            
+            # Shuffle and create pairs
+            random.shuffle(users)
+            
+            # (receiver, giver) pairs: each user gifts to the next one in the circle
+            n = len(users)
+            pairs = [(users[(i + 1) % n], users[i]) for i in range(n)]
+            cursor.executemany(SQL_SET_SANTA, pairs)
+
+            cursor.execute(SQL_SET_EVENT_STARTED)
+            
+            # Read back the pairs in the same transaction for the broadcast
+            cursor.execute(SQL_GET_NEW_ASSIGNMENTS)
+            assignments = cursor.fetchall()
+        self._invalidate_settings()
         
-        return len(users)
+        return assignments
     
     def delete_user(self, user_db_id):
         """Delete user from database"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        
-        # Get user info before deletion
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_db_id,))
-        user_info = cursor.fetchone()
-        
-        if user_info:
-            # Delete the user
-            cursor.execute("DELETE FROM users WHERE id = ?", (user_db_id,))
-            conn.commit()
+        with self.conn:
+            cursor = self.conn.cursor()
+            # Other workers may write concurrently, so lock before reading
+            cursor.execute("BEGIN IMMEDIATE")
+            
+            # Get user info before deletion
+            cursor.execute(SQL_GET_USER_BY_ID, (user_db_id,))
+            user_info = cursor.fetchone()
+            
+            if user_info:
+                # Delete the user
+                cursor.execute(SQL_DELETE_USER, (user_db_id,))
         
-        conn.close()
         return user_info
     
-    def notify_all_users(self):
-        """Notify all users about their assignments"""
-        users = self.get_all_users()
-        for user in users:
-            self.show_assignment(user[1], user[0])  # user[1] is telegram_id, user[0] is db_id
+    def broadcast_assignments(self, rows):
+        """Send (giver_telegram_id, giver_id, receiver_id, preferences) rows to their givers"""
+        def notify(row):
+            telegram_id, giver_id, receiver_id, preferences = row
+            try:
+                self._send_assignment(telegram_id, receiver_id, preferences)
+            except Exception as e:
+                logger.error(f"Failed to notify Santa {giver_id} ({telegram_id}): {e}")
+        
+        # Messages go to different chats, so they can be sent in parallel
+        return [self.send_pool.submit(notify, row) for row in rows]
     
     def mark_gift_delivered(self, user_db_id):
         """Mark gift as delivered"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET gift_delivered = 1 WHERE id = ?", (user_db_id,))
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
+        with self.conn:
+            cursor = self.conn.execute(SQL_MARK_DELIVERED, (user_db_id,))
+        return cursor.rowcount > 0
     
     def mark_gift_received(self, user_db_id):
         """Mark gift as received"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET gift_received = 1 WHERE id = ?", (user_db_id,))
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
+        with self.conn:
+            cursor = self.conn.execute(SQL_MARK_RECEIVED, (user_db_id,))
+        return cursor.rowcount > 0
     
     def notify_gift_delivered(self, user_db_id):
         """Notify receiver that their gift was delivered"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        
-        # Find who is giving to this user
-        cursor.execute("SELECT id FROM users WHERE santa_id = ?", (user_db_id,))
-        giver_result = cursor.fetchone()
-        
-        if giver_result:
-            giver_id = giver_result[0]
-            # Get receiver's telegram_id
-            cursor.execute("SELECT telegram_id FROM users WHERE id = ?", (user_db_id,))
-            receiver_telegram = cursor.fetchone()
-            
-            if receiver_telegram:
-                telegram_id = receiver_telegram[0]
-                self.send_message(telegram_id, "🎉 Тайный Дед Мороз доставил тебе подарок! Приходи в аудиторию 257!")
+        # Get receiver's telegram_id
+        receiver_telegram = self.conn.execute(SQL_GET_TELEGRAM_ID, (user_db_id,)).fetchone()
         
-        conn.close()
+        if receiver_telegram:
+            self.send_message(receiver_telegram[0], "🎉 Тайный Дед Мороз доставил тебе подарок! Приходи в аудиторию 257!")
     
     def notify_gift_received(self, user_db_id):
         """Notify user that their gift was received"""
-        conn = sqlite3.connect('santa.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT telegram_id FROM users WHERE id = ?", (user_db_id,))
+        cursor = self.conn.cursor()
+        cursor.execute(SQL_GET_TELEGRAM_ID, (user_db_id,))
         result = cursor.fetchone()
-        conn.close()
         
         if result:
             telegram_id = result[0]
@@ -430,76 +617,145 @@ class SimpleSantaBot:
     
     def handle_message(self, chat_id, user_id, user_name, text):
         """Handle regular messages"""
-        if user_id in self.user_data:
-            step = self.user_data[user_id]["step"]
+        with self._user_data_lock:
+            state = self.user_data.get(user_id)
+            if state is not None:
+                state.ts = time.monotonic()
+        
+        if state is not None:
+            step = state.step
             
             if step == "fio":
-                self.user_data[user_id]["fio"] = text
-                self.user_data[user_id]["step"] = "group"
+                state.fio = text
+                state.step = "group"
                 self.send_message(chat_id, "Отлично! Теперь введи свою учебную группу:")
                 
             elif step == "group":
-                self.user_data[user_id]["group"] = text
-                self.user_data[user_id]["step"] = "preferences"
+                state.group = text
+                state.step = "preferences"
                 self.send_message(chat_id, "Супер! Теперь опиши свои предпочтения:\n• Что ты любишь?\n• Что не любишь?\n• Какие подарки хотел бы получить?")
                 
             elif step == "preferences":
-                user_info = self.user_data[user_id]
-                
                 # Save to database
-                conn = sqlite3.connect('santa.db')
-                cursor = conn.cursor()
                 try:
-                    cursor.execute(
-                        "INSERT INTO users (telegram_id, fio, group_name, preferences) VALUES (?, ?, ?, ?)",
-                        (user_id, user_info["fio"], user_info["group"], text)
-                    )
-                    user_db_id = cursor.lastrowid
-                    conn.commit()
+                    with self.conn:
+                        if SQLITE_HAS_RETURNING:
+                            user_db_id = self.conn.execute(SQL_INSERT_USER_RETURNING, (user_id, state.fio, state.group, text)).fetchone()[0]
+                        else:
+                            user_db_id = self.conn.execute(SQL_INSERT_USER, (user_id, state.fio, state.group, text)).lastrowid
                     
-                    self.send_message(chat_id, f"🎉 Регистрация завершена! 🎉\n\nТвой ID: Тайный Дед Мороз {user_db_id}\nФИО: {user_info['fio']}\nГруппа: {user_info['group']}\n\nЖди начала мероприятия!")
+                    self.send_message(chat_id, f"🎉 Регистрация завершена! 🎉\n\nТвой ID: Тайный Дед Мороз {user_db_id}\nФИО: {state.fio}\nГруппа: {state.group}\n\nЖди начала мероприятия!")
                     logger.info(f"User {user_id} registered as Santa {user_db_id}")
                     
                 except sqlite3.IntegrityError:
                     self.send_message(chat_id, "Ты уже зарегистрирован!")
-                finally:
-                    conn.close()
                 
                 # Cleanup
-                del self.user_data[user_id]
+                with self._user_data_lock:
+                    self.user_data.pop(user_id, None)
         
         else:
             self.send_message(chat_id, "Используй /start для регистрации!")
     
-    def process_updates(self, updates):
-        """Process incoming messages"""
-        for update in updates:
-            self.last_update_id = update["update_id"]
+    def reap_user_data(self):
+        """Drop registrations abandoned for longer than REG_STATE_TTL"""
+        deadline = time.monotonic() - REG_STATE_TTL
+        # Check and remove under the lock, so a refreshed or restarted registration is kept
+        with self._user_data_lock:
+            stale = [user_id for user_id, state in self.user_data.items() if state.ts < deadline]
+            for user_id in stale:
+                del self.user_data[user_id]
+        if stale:
+            logger.info(f"Dropped {len(stale)} abandoned registrations")
+    
+    def _prompt_start(self, chat_id, user_id):
+        """Point unknown users to /start, only once per user"""
+        with self._prompted_lock:
+            if user_id in self._prompted:
+                self._prompted.move_to_end(user_id)
+                return
             
-            if "message" in update:
-                message = update["message"]
-                chat_id = message["chat"]["id"]
-                user_id = message["from"]["id"]
-                user_name = message["from"].get("first_name", "Друг")
-                text = message.get("text", "").strip()
-                
-                logger.info(f"Message from {user_name} ({user_id}): {text}")
-                
-                # Check if admin command
-                if text.startswith("/") and any(text.startswith(cmd) for cmd in ["/stats", "/users", "/close", "/open", "/start_event", "/del", "/gift", "/received", "/help_admin"]):
-                    self.handle_admin_commands(chat_id, text, user_id)
-                elif text == "/start":
-                    self.handle_start(chat_id, user_id, user_name)
-                elif text == "/help":
-                    help_text = """🎅 Помощь по боту:
+            self._prompted[user_id] = True
+            if len(self._prompted) > PROMPTED_CACHE_SIZE:
+                self._prompted.popitem(last=False)
+        
+        self.send_message(chat_id, "Используй /start для регистрации!")
+    
+    def process_update(self, update):
+        """Process a single update"""
+        if "message" in update:
+            message = update["message"]
+            chat_id = message["chat"]["id"]
+            user_id = message["from"]["id"]
+            user_name = message["from"].get("first_name", "Друг")
+            text = message.get("text", "").strip()
+            
+            # Stickers, photos and other non-text messages
+            if not text:
+                return
+            
+            logger.info(f"Message from {user_name} ({user_id}): {text}")
+            
+            # Plain text from someone who isn't registering
+            if not text.startswith("/") and user_id not in self.user_data:
+                self._prompt_start(chat_id, user_id)
+                return
+            
+            # Check if admin command
+            command = text.split(" ", 1)[0]
+            admin_handler = self._admin_dispatch.get(command)
+            if admin_handler:
+                self.handle_admin_commands(chat_id, text, user_id, admin_handler)
+            elif text == "/start":
+                self.handle_start(chat_id, user_id, user_name)
+            elif text == "/help":
+                help_text = """🎅 Помощь по боту:
 
 /start - регистрация или проверка статуса
 /help - эта справка
 
 Для организаторов доступны команды /help_admin"""
-                    self.send_message(chat_id, help_text)
-                else:
-                    self.handle_message(chat_id, user_id, user_name, text)
+                self.send_message(chat_id, help_text)
+            else:
+                self.handle_message(chat_id, user_id, user_name, text)
+    
+    def start_workers(self):
+        """Start worker threads that handle updates"""
+        for i in range(self.num_workers):
+            work_queue = queue.Queue()
+            worker = threading.Thread(target=self._worker, args=(work_queue,), name=f"worker-{i}", daemon=True)
+            worker.start()
+            self.work_queues.append(work_queue)
+    
+    def stop_workers(self):
+        """Let workers finish queued updates and stop"""
+        for work_queue in self.work_queues:
+            work_queue.put(None)
+        for work_queue in self.work_queues:
+            work_queue.join()
+        self.work_queues = []
+    
+    def _worker(self, work_queue):
+        """Worker loop: handle updates until stopped"""
+        while True:
+            update = work_queue.get()
+            try:
+                if update is None:
+                    return
+                self.process_update(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.get('update_id')}: {e}")
+            finally:
+                work_queue.task_done()
+    
+    def enqueue_updates(self, updates):
+        """Hand updates to workers, keeping per-chat order"""
+        for update in updates:
+            # Advance the offset right away so polling never waits on handlers
+            self.last_update_id = update["update_id"]
+            
+            chat_id = update.get("message", {}).get("chat", {}).get("id", 0)
+            self.work_queues[hash(chat_id) % len(self.work_queues)].put(update)
     
     def run(self):
         """Main bot loop"""
@@ -514,6 +770,9 @@ class SimpleSantaBot:
         
         empty_responses = 0
         max_empty_responses = 10
+        last_sweep = time.monotonic()
+        
+        self.start_workers()
         
         while True:
             try:
@@ -521,14 +780,16 @@ class SimpleSantaBot:
                 
                 if updates:
                     empty_responses = 0
-                    self.process_updates(updates)
+                    self.enqueue_updates(updates)
                 else:
                     empty_responses += 1
                     if empty_responses >= max_empty_responses:
                         logger.info("No messages for a while, still waiting...")
                         empty_responses = 0
                 
-                time.sleep(1)
+                if time.monotonic() - last_sweep >= REG_SWEEP_INTERVAL:
+                    self.reap_user_data()
+                    last_sweep = time.monotonic()
                 
             except KeyboardInterrupt:
                 logger.info("Bot stopped by user")
@@ -536,6 +797,9 @@ class SimpleSantaBot:
             except Exception as e:
                 logger.error(f"Unexpected error: {e}")
                 time.sleep(5)
+        
+        self.stop_workers()
+        self.send_pool.shutdown(wait=True)
 
 if __name__ == "__main__":
     